@@ -0,0 +1,179 @@
+import argparse
+import csv
+import itertools
+import statistics
+import threading
+import time
+import requests
+from api_main import compressors, queries
+from data_insert import dbconn, insert_rows_parallel
+
+base_url = "http://127.0.0.1:5000"
+
+endpoints = [
+    {"url": f"{base_url}/getNOrders", "tokens": {'limit': 1000}},
+    {"url": f"{base_url}/getNCustomers", "tokens": {'limit': 1000}},
+    {"url": f"{base_url}/getNSellers", "tokens": {'limit': 1000}},
+    {"url": f"{base_url}/getOrders", "tokens": {"start": "2017-01-01", "end": "2017-12-31"}},
+    {"url": f"{base_url}/getNProducts", "tokens": {'limit': 1000}},
+    {"url": f"{base_url}/getLocationsWithHighestAvgOrderValue", "tokens": {'limit': 10}},
+    {"url": f"{base_url}/getMostProfitableLocations", "tokens": {'limit': 10}},
+    {"url": f"{base_url}/getTop5CustomersOnSpendings", "tokens": {}}
+]
+
+compression_levels = {"gzip": [1, 5, 9], "br": [1, 4, 11], "zstd": [1, 3, 19]}
+
+# Data and index size of every table, as reported by the server
+def table_sizes():
+    conn, cur = dbconn()
+    try:
+        cur.execute('''
+            SELECT table_name, table_rows, data_length, index_length
+            FROM information_schema.tables
+            WHERE table_schema = DATABASE()
+            ORDER BY table_name
+        ''')
+        return cur.fetchall()
+    finally:
+        cur.close()
+        conn.close()
+
+# Query plan of the date-range endpoint; the partitions column shows which partitions are read
+def explain_date_range(start_date, end_date):
+    conn, cur = dbconn()
+    try:
+        cur.execute("EXPLAIN " + queries["getOrders"]["sql"], (start_date, end_date))
+        column_names = [desc[0] for desc in cur.description]
+        return [dict(zip(column_names, row)) for row in cur.fetchall()]
+    finally:
+        cur.close()
+        conn.close()
+
+# Round trip and sqltime percentiles for each endpoint
+def endpoint_latency(repeat):
+    results = []
+    for endpoint in endpoints:
+        wall_times = []
+        sql_times = []
+        for _ in range(repeat):
+            start_time = time.perf_counter()
+            response = requests.get(endpoint["url"], params=endpoint["tokens"])
+            wall_times.append(time.perf_counter() - start_time)
+            sql_times.append(response.json().get("sqltime") or 0)
+        results.append((endpoint["url"].rsplit("/", 1)[-1], wall_times, sql_times))
+    return results
+
+# Compression time and ratio per encoding and level on the uncompressed endpoint bodies
+def compression_tradeoff(levels):
+    results = []
+    for endpoint in endpoints:
+        body = requests.get(endpoint["url"], params=endpoint["tokens"], headers={"Accept-Encoding": "identity"}).content
+        for encoding, compress in compressors.items():
+            for level in levels[encoding]:
+                start_time = time.perf_counter()
+                compressed = compress(body, level)
+                results.append((endpoint["url"].rsplit("/", 1)[-1], encoding, level, len(body), len(compressed),
+                                time.perf_counter() - start_time))
+    return results
+
+heavy_endpoints = [f"{base_url}/getMostProfitableLocations", f"{base_url}/getLocationsWithHighestAvgOrderValue"]
+cheap_endpoint = f"{base_url}/getNCustomers"
+
+# Latency of a cheap endpoint while flood_threads clients keep calling the heavy aggregates.
+# A unique nocache parameter keeps the heavy calls from being answered by the ETag/compressed caches.
+def cheap_latency_under_flood(flood_threads, duration):
+    stop = threading.Event()
+    counter = itertools.count()
+    shed = {"heavy": 0, "cheap": 0}
+
+    def flood(url):
+        while not stop.is_set():
+            response = requests.get(url, params={"limit": 10, "nocache": next(counter)})
+            if response.json().get("code") == 0:
+                shed["heavy"] += 1
+
+    threads = [threading.Thread(target=flood, args=(heavy_endpoints[i % len(heavy_endpoints)],), daemon=True)
+               for i in range(flood_threads)]
+    for thread in threads:
+        thread.start()
+    latencies = []
+    queue_times = []
+    end_time = time.perf_counter() + duration
+    while time.perf_counter() < end_time:
+        start_time = time.perf_counter()
+        response = requests.get(cheap_endpoint, params={"limit": 20, "nocache": next(counter)}).json()
+        latencies.append(time.perf_counter() - start_time)
+        queue_times.append(response.get("queuetime") or 0)
+        if response.get("code") == 0:
+            shed["cheap"] += 1
+    stop.set()
+    for thread in threads:
+        thread.join()
+    return latencies, queue_times, shed
+
+# GeoLocations insert throughput for each shard count, into a scratch copy of the table
+def parallel_insert_throughput(geo_file, shard_counts):
+    with open(geo_file, 'r', encoding='utf-8') as csvfile:
+        rows = [(float(row['geolocation_lat']), float(row['geolocation_lng']), None) for row in csv.DictReader(csvfile)]
+    conn, cur = dbconn()
+    results = []
+    try:
+        cur.execute('DROP TABLE IF EXISTS GeoLocationsBench')
+        cur.execute('CREATE TABLE GeoLocationsBench LIKE GeoLocations')
+        for shards in shard_counts:
+            cur.execute('TRUNCATE TABLE GeoLocationsBench')
+            start_time = time.perf_counter()
+            count = insert_rows_parallel('GeoLocationsBench', ('latitude', 'longitude', 'location_key'), iter(rows), shards)
+            results.append((shards, count, time.perf_counter() - start_time))
+    finally:
+        cur.execute('DROP TABLE IF EXISTS GeoLocationsBench')
+        cur.close()
+        conn.close()
+    return results
+
+def percentile(values, pct):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct / 100))]
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure table sizes and endpoint latency for the loaded schema.")
+    parser.add_argument("--label", default="default", help="name of the schema mode being measured, e.g. varchar, binary or partitioned")
+    parser.add_argument("--repeat", type=int, default=20, help="requests per endpoint")
+    parser.add_argument("--flood-threads", type=int, default=16, help="concurrent heavy-query clients in the flood test")
+    parser.add_argument("--flood-seconds", type=float, default=30, help="duration of the flood test")
+    parser.add_argument("--geo-file", default="geolocation.csv", help="rows used for the parallel insert test")
+    parser.add_argument("--shards", default="1,2,4,8,16", help="comma-separated connection counts for the parallel insert test")
+    args = parser.parse_args()
+
+    print(f"== {args.label} ==")
+    print(f"{'table':<15}{'rows':>10}{'data_kb':>12}{'index_kb':>12}")
+    for table_name, table_rows, data_length, index_length in table_sizes():
+        print(f"{table_name:<15}{table_rows:>10}{data_length // 1024:>12}{index_length // 1024:>12}")
+
+    for start_date, end_date in [("2017-01-01", "2017-01-31"), ("2017-01-01", "2017-12-31")]:
+        for plan in explain_date_range(start_date, end_date):
+            print(f"getOrders {start_date}..{end_date}: table={plan['table']} partitions={plan.get('partitions')} "
+                  f"type={plan['type']} rows={plan['rows']}")
+
+    print(f"{'endpoint':<40}{'p50_ms':>10}{'p95_ms':>10}{'sql_p50_ms':>12}")
+    for name, wall_times, sql_times in endpoint_latency(args.repeat):
+        print(f"{name:<40}{statistics.median(wall_times) * 1000:>10.1f}{percentile(wall_times, 95) * 1000:>10.1f}"
+              f"{statistics.median(sql_times) * 1000:>12.1f}")
+
+    print(f"{'endpoint':<40}{'encoding':>9}{'level':>6}{'bytes':>10}{'compressed':>11}{'ratio':>7}{'cpu_ms':>8}")
+    for name, encoding, level, size, compressed_size, cpu_time in compression_tradeoff(compression_levels):
+        print(f"{name:<40}{encoding:>9}{level:>6}{size:>10}{compressed_size:>11}{size / max(compressed_size, 1):>7.1f}"
+              f"{cpu_time * 1000:>8.2f}")
+
+    latencies, queue_times, shed = cheap_latency_under_flood(args.flood_threads, args.flood_seconds)
+    print(f"getNCustomers under {args.flood_threads} heavy clients: requests={len(latencies)} "
+          f"p50={percentile(latencies, 50) * 1000:.1f}ms p95={percentile(latencies, 95) * 1000:.1f}ms "
+          f"p99={percentile(latencies, 99) * 1000:.1f}ms queue_p99={percentile(queue_times, 99) * 1000:.1f}ms "
+          f"shed_cheap={shed['cheap']} shed_heavy={shed['heavy']}")
+
+    print(f"{'shards':>6}{'rows':>10}{'seconds':>9}{'rows_per_s':>12}")
+    for shards, count, elapsed in parallel_insert_throughput(args.geo_file, [int(n) for n in args.shards.split(",")]):
+        print(f"{shards:>6}{count:>10}{elapsed:>9.1f}{count / elapsed:>12.0f}")
+
+if __name__ == "__main__":
+    main()
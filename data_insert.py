@@ -1,16 +1,28 @@
 # %%
+import argparse
 import csv
+import json
+import multiprocessing
+import os
 import pymysql
+import queue
+import re
+import sys
+import threading
+import time
+import uuid
 from datetime import datetime
 import yaml
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
 from pathlib import Path
+from profiling import add_worker_stats, profile_modes, profile_section, profiled, run_profiled, worker_profile_mode
 
 
 create_table_queries = [
     '''
     CREATE TABLE Products (
         product_key INT AUTO_INCREMENT PRIMARY KEY,
-        product_id VARCHAR(100) NOT NULL UNIQUE,
+        product_id {id_type} NOT NULL UNIQUE,
         product_category VARCHAR(100),
         product_name_length INT,
         product_description_length INT,
@@ -44,7 +56,7 @@ create_table_queries = [
     '''
     CREATE TABLE Customers (
         customer_key INT AUTO_INCREMENT PRIMARY KEY,
-        customer_unique_id VARCHAR(100) NOT NULL UNIQUE,
+        customer_unique_id {id_type} NOT NULL UNIQUE,
         location_key INT,
         FOREIGN KEY (location_key) REFERENCES Locations(location_key)
     );
@@ -52,7 +64,7 @@ create_table_queries = [
     '''
     CREATE TABLE Sellers (
         seller_key INT AUTO_INCREMENT PRIMARY KEY,
-        seller_id VARCHAR(100) NOT NULL UNIQUE,
+        seller_id {id_type} NOT NULL UNIQUE,
         location_key INT,
         FOREIGN KEY (location_key) REFERENCES Locations(location_key)
     );
@@ -60,7 +72,7 @@ create_table_queries = [
     '''
     CREATE TABLE Orders (
         order_key INT AUTO_INCREMENT PRIMARY KEY,
-        order_id VARCHAR(100) NOT NULL UNIQUE,
+        order_id {id_type} NOT NULL UNIQUE,
         customer_key INT,
         order_status VARCHAR(25),
         order_purchase_date DATETIME,
@@ -97,6 +109,112 @@ create_table_queries = [
     '''
 ]
 
+# Partitioned variants of the fact tables, range-partitioned by purchase month so date-range queries
+# only read the matching partitions. MySQL needs the partitioning column in every unique key and does
+# not allow foreign keys on (or referencing) partitioned tables, so those become composite keys and plain indexes.
+partitioned_table_queries = {
+    'Orders': '''
+    CREATE TABLE Orders (
+        order_key INT AUTO_INCREMENT,
+        order_id {id_type} NOT NULL,
+        customer_key INT,
+        order_status VARCHAR(25),
+        order_purchase_date DATETIME NOT NULL,
+        order_approved_date DATETIME,
+        order_delivered_carrier_date DATETIME,
+        order_delivered_customer_date DATETIME,
+        order_estimated_delivery_date DATETIME,
+        PRIMARY KEY (order_key, order_purchase_date),
+        UNIQUE KEY (order_id, order_purchase_date),
+        KEY (customer_key)
+    )
+    PARTITION BY RANGE (TO_DAYS(order_purchase_date)) ({partitions});
+    ''',
+    'Payments': '''
+    CREATE TABLE Payments (
+        payments_key INT AUTO_INCREMENT PRIMARY KEY,
+        order_key INT,
+        payment_type VARCHAR(25),
+        payment_installments INT,
+        payment_value DECIMAL(10, 2),
+        KEY (order_key)
+    );
+    ''',
+    'OrderItems': '''
+    CREATE TABLE OrderItems (
+        order_items_key INT AUTO_INCREMENT,
+        order_key INT,
+        product_key INT,
+        seller_key INT,
+        qty INT,
+        unit_price DECIMAL(10, 2),
+        total_price DECIMAL(10, 2),
+        order_purchase_date DATETIME NOT NULL,
+        PRIMARY KEY (order_items_key, order_purchase_date),
+        KEY (order_key),
+        KEY (product_key),
+        KEY (seller_key)
+    )
+    PARTITION BY RANGE (TO_DAYS(order_purchase_date)) ({partitions});
+    '''
+}
+partitioned_tables = ['OrderItems', 'Orders']
+# Orders in the dataset span 2016-09 to 2018-10; later months go to pmax until added with --add-partition
+partition_months = ('2016-09', '2018-10')
+partitioned = False
+
+def next_month(month):
+    year, month = map(int, month.split('-'))
+    return f'{year + month // 12}-{month % 12 + 1:02d}'
+
+# argparse type of the YYYY-MM arguments, so a malformed month is rejected before any table is touched
+def month_argument(value):
+    try:
+        return datetime.strptime(value, '%Y-%m').strftime('%Y-%m')
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid month '{value}', expected YYYY-MM")
+
+def partition_definition(month):
+    return f"PARTITION p{month.replace('-', '')} VALUES LESS THAN (TO_DAYS('{next_month(month)}-01'))"
+
+# One partition per month in the range plus a catch-all pmax
+def partition_definitions(first_month, last_month):
+    definitions = []
+    month = first_month
+    while month <= last_month:
+        definitions.append(partition_definition(month))
+        month = next_month(month)
+    definitions.append('PARTITION pmax VALUES LESS THAN MAXVALUE')
+    return ',\n        '.join(definitions)
+
+# Business ids (order_id, customer_unique_id, product_id, seller_id) are always 32-char hex,
+# so the compact schema stores them as BINARY(16) instead of VARCHAR(100)
+id_column_types = {False: 'VARCHAR(100)', True: 'BINARY(16)'}
+compact_ids = False
+
+# Converts a hex id from the csv files into the value stored in the database
+def encode_id(value):
+    if compact_ids and value:
+        return bytes.fromhex(value)
+    return value
+
+# Converts an id read back from the database into its hex form
+def decode_id(value):
+    if isinstance(value, (bytes, bytearray)):
+        return value.hex()
+    return value
+
+# Written after every load or partition change; the API derives its ETag/Last-Modified headers from it
+data_version_file = 'data_version.json'
+
+def write_data_version():
+    stamp = {'version': uuid.uuid4().hex, 'loaded_at': time.time()}
+    # Written to a temporary file and renamed, so the API never reads a half-written stamp
+    temp_file = Path(f'{data_version_file}.tmp')
+    temp_file.write_text(json.dumps(stamp))
+    os.replace(temp_file, data_version_file)
+    print(f"Data version {stamp['version']} written to {data_version_file}.")
+
 # For Database connection
 def dbconn():
     # conn = pymysql.connect(
@@ -129,85 +247,309 @@ def create_tables():
             cur.execute(f'DROP TABLE IF EXISTS {table};')
         
         # Creating tables
+        id_type = id_column_types[compact_ids]
+        partitions = partition_definitions(*partition_months)
         for query in create_table_queries:
-            cur.execute(query)
+            table = re.search(r'CREATE TABLE (\w+)', query).group(1)
+            if partitioned and table in partitioned_table_queries:
+                query = partitioned_table_queries[table]
+            cur.execute(query.format(id_type=id_type, partitions=partitions))
         conn.commit()
         print("Tables created successfully.")
     except pymysql.Error as e:
         print(f"Error creating tables: {e}")
+        raise
+    finally:
+        cur.close()
+        conn.close()
+
+# Partition names of each partitioned table, in range order; a table that is not partitioned has none
+def table_partitions(cur):
+    cur.execute('''
+        SELECT table_name, partition_name FROM information_schema.PARTITIONS
+        WHERE table_schema = DATABASE() AND table_name IN %s AND partition_name IS NOT NULL
+        ORDER BY table_name, partition_ordinal_position
+    ''', (tuple(partitioned_tables),))
+    partitions = {table: [] for table in partitioned_tables}
+    for table, partition in cur.fetchall():
+        partitions[table].append(partition)
+    return partitions
+
+def partition_month(partition):
+    return f'{partition[1:5]}-{partition[5:7]}'
+
+# Splits the catch-all pmax partition so the given month (YYYY-MM) gets its own partition. Any months between
+# the last partition and the given month get their own partitions too, so every partition holds exactly one month.
+def add_partition(month):
+    conn, cur = dbconn()
+    try:
+        partitions = table_partitions(cur)
+        if (any(len(partitions[table]) < 2 or partitions[table][-1] != 'pmax' for table in partitioned_tables)
+                or partitions['Orders'] != partitions['OrderItems']):
+            print(f"Error adding partition for {month}: Orders and OrderItems are not partitioned by month.")
+            return False
+        last_month = partition_month(partitions['Orders'][-2])
+        if month <= last_month:
+            print(f"Error adding partition for {month}: partitions already exist up to {last_month}.")
+            return False
+        definitions = []
+        while last_month < month:
+            last_month = next_month(last_month)
+            definitions.append(partition_definition(last_month))
+        for table in partitioned_tables:
+            cur.execute(f'''
+                ALTER TABLE {table} REORGANIZE PARTITION pmax INTO (
+                    {', '.join(definitions)},
+                    PARTITION pmax VALUES LESS THAN MAXVALUE
+                )
+            ''')
+        print(f"Added partition for {month}.")
+        return True
+    except pymysql.Error as e:
+        print(f"Error adding partition for {month}: {e}")
+        return False
+    finally:
+        cur.close()
+        conn.close()
+
+# Removes a month's orders, order items and their payments. Only the oldest partition is dropped outright;
+# dropping a later one would let the next partition absorb its date range, so later months are truncated instead
+# and keep their one-month partition.
+# ALTER TABLE commits implicitly, so the steps cannot share a transaction. Order items go first and payments last,
+# deleted as payments left without an order, so a run that fails partway can simply be repeated.
+def drop_partition(month):
+    conn, cur = dbconn()
+    partition = f"p{month.replace('-', '')}"
+    try:
+        partitions = table_partitions(cur)
+        if not any(partition in partitions[table] for table in partitioned_tables):
+            print(f"Error dropping partition for {month}: {partition} does not exist in Orders or OrderItems.")
+            return False
+        for table in partitioned_tables:
+            if partition not in partitions[table]:
+                continue
+            action = 'DROP' if partitions[table][0] == partition else 'TRUNCATE'
+            cur.execute(f"ALTER TABLE {table} {action} PARTITION {partition}")
+        cur.execute('''
+            DELETE p FROM Payments p LEFT JOIN Orders o ON o.order_key = p.order_key
+            WHERE o.order_key IS NULL
+        ''')
+        print(f"Dropped partition for {month}.")
+        return True
+    except pymysql.Error as e:
+        print(f"Error dropping partition for {month}: {e}")
+        return False
+    finally:
+        cur.close()
+        conn.close()
+
+# %%
+# Rows are parsed on a background thread and handed to the writer in chunks through a bounded queue,
+# so csv parsing overlaps with the round trips to MySQL and only a few chunks are in memory at a time
+def pipelined(rows, chunk_size=5000, max_chunks=8):
+    chunk_queue = queue.Queue(maxsize=max_chunks)
+    finished = object()
+    errors = []
+    # Set when the writer stops early, so the parser does not stay blocked on a full queue
+    stopped = threading.Event()
+
+    def put(item):
+        while not stopped.is_set():
+            try:
+                chunk_queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def parse():
+        try:
+            chunk = []
+            for row in rows:
+                chunk.append(row)
+                if len(chunk) == chunk_size:
+                    if not put(chunk):
+                        return
+                    chunk = []
+            if chunk:
+                put(chunk)
+        except Exception as e:
+            errors.append(e)
+        finally:
+            # Closes the generator, and with it the csv file, when the writer stopped early
+            if hasattr(rows, 'close'):
+                rows.close()
+            put(finished)
+
+    parser = threading.Thread(target=profiled(parse), daemon=True)
+    parser.start()
+    try:
+        while True:
+            chunk = chunk_queue.get()
+            if chunk is finished:
+                break
+            yield from chunk
+    finally:
+        stopped.set()
+        parser.join()
+    if errors:
+        raise errors[0]
+
+# Largest INSERT statement we build, kept under the server's max_allowed_packet
+def max_statement_size(cur):
+    cur.execute('SELECT @@max_allowed_packet')
+    max_allowed_packet = cur.fetchone()[0]
+    return min(int(max_allowed_packet * 0.9), 16 * 1024 * 1024)
+
+# Deadlocks and lock wait timeouts only roll back the failed statement (autocommit is on), so it is sent again
+retryable_errors = {1205, 1213}
+insert_retries = 5
+
+def execute_with_retry(cur, sql):
+    for attempt in range(insert_retries):
+        try:
+            return cur.execute(sql)
+        except pymysql.MySQLError as e:
+            if e.args[0] not in retryable_errors or attempt == insert_retries - 1:
+                raise
+            time.sleep(0.1 * 2 ** attempt)
+
+# Sends rows as multi-row INSERT statements, each sized to fit in one packet
+def insert_rows(cur, table, columns, rows):
+    statement_size = max_statement_size(cur)
+    insert_sql = f"INSERT INTO {table} ({', '.join(columns)}) VALUES "
+    placeholder = '(' + ', '.join(['%s'] * len(columns)) + ')'
+    values = []
+    size = len(insert_sql)
+    count = 0
+    for row in rows:
+        value = cur.mogrify(placeholder, row)
+        # max_allowed_packet is in bytes, and city names can be multi-byte in utf8mb4
+        value_size = len(value.encode())
+        if values and size + value_size + 1 > statement_size:
+            execute_with_retry(cur, insert_sql + ','.join(values))
+            values = []
+            size = len(insert_sql)
+        values.append(value)
+        size += value_size + 1
+        count += 1
+    if values:
+        execute_with_retry(cur, insert_sql + ','.join(values))
+    return count
+
+# Number of connections used for the largest tables (GeoLocations, OrderItems), set with --parallel
+parallel_shards = 1
+
+# Connection of an insert worker process, opened once by the pool initializer
+shard_connection = None
+
+def open_shard_connection():
+    global shard_connection
+    shard_connection = dbconn()
+
+def insert_shard_chunk(table, columns, chunk, profile_mode=None):
+    conn, cur = shard_connection
+    if profile_mode == 'cprofile':
+        return run_profiled(insert_rows, cur, table, columns, chunk)
+    return insert_rows(cur, table, columns, chunk), None
+
+# Splits the rows into shards that are inserted at the same time, each by a worker process on its own connection.
+# Formatting the statements is CPU bound, so processes are used rather than threads to keep it off one GIL.
+# Parsing the csv and pickling the chunks for the workers still happen in this process, which caps the speed-up.
+# At most two chunks per worker are in flight, and the first failed chunk stops the feeding.
+def insert_rows_parallel(table, columns, rows, shards, chunk_size=5000):
+    profile_mode = worker_profile_mode()
+    count = 0
+    pending = set()
+
+    def collect(done):
+        nonlocal count
+        for future in done:
+            chunk_count, stats = future.result()
+            count += chunk_count
+            add_worker_stats(stats)
+
+    try:
+        with ProcessPoolExecutor(max_workers=shards, mp_context=multiprocessing.get_context('spawn'),
+                                 initializer=open_shard_connection) as executor:
+            try:
+                chunk = []
+                for row in rows:
+                    chunk.append(row)
+                    if len(chunk) == chunk_size:
+                        if len(pending) >= shards * 2:
+                            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                            collect(done)
+                        pending.add(executor.submit(insert_shard_chunk, table, columns, chunk, profile_mode))
+                        chunk = []
+                if chunk:
+                    pending.add(executor.submit(insert_shard_chunk, table, columns, chunk, profile_mode))
+                done, pending = wait(pending)
+                collect(done)
+            except BaseException:
+                for future in pending:
+                    future.cancel()
+                raise
+    finally:
+        # Stops the parser thread of a pipelined() source when feeding ends early
+        if hasattr(rows, 'close'):
+            rows.close()
+
+    # Refresh the index statistics once the bulk load is done
+    conn, cur = dbconn()
+    try:
+        cur.execute(f'ANALYZE TABLE {table}')
+        cur.fetchall()
     finally:
         cur.close()
         conn.close()
+    return count
+
+def insert_large_table(cur, table, columns, rows):
+    if parallel_shards > 1:
+        return insert_rows_parallel(table, columns, rows, parallel_shards)
+    return insert_rows(cur, table, columns, rows)
 
 # %%
 def insert_locations_and_geolocation(geo_file):
     conn, cur = dbconn()
     try:
+        # To track unique zip codes for Locations
+        unique_zip = {}
         with open(geo_file, 'r', encoding='utf-8') as csvfile:
             reader = csv.DictReader(csvfile)
-            
-            # To track unique zip codes for Locations
-            unique_zip = {}
-            geolocation_data = []
-
             for row in reader:
                 zip_code = row['geolocation_zip_code_prefix']
-                city = row['geolocation_city']
-                state = row['geolocation_state']
-                latitude = float(row['geolocation_lat'])
-                longitude = float(row['geolocation_lng'])
-
                 if zip_code not in unique_zip:
-                    unique_zip[zip_code] = (city, state)
-
-                geolocation_data.append((zip_code, latitude, longitude))
-
-            # Inserting unique locations into Locations
-            insert_location_data_sql = '''
-                    INSERT INTO Locations (zip_code, city, state)
-                    VALUES (%s, %s, %s)
-                '''
-            location_batch = []
-            for zip_code, (city, state) in unique_zip.items():
-                location_batch.append((zip_code, city, state))
-                if len(location_batch) == 5000:
-                    cur.executemany(insert_location_data_sql, location_batch)
-                    conn.commit()
-                    location_batch = []
-            
-            if location_batch:
-                cur.executemany(insert_location_data_sql, location_batch)
-                conn.commit()
-
-            print(f"Inserted data into Locations.")
-
-            # Retrieving location keys for GeoLocations
-            location_map = {}
-            cur.execute('SELECT zip_code, location_key FROM Locations')
-            for zip_code, location_key in cur.fetchall():
-                location_map[zip_code] = location_key
-
-            # Inserting data into GeoLocations using location_key
-            insert_geo_loc_data_sql = '''
-                    INSERT INTO GeoLocations (latitude, longitude, location_key)
-                    VALUES (%s, %s, %s)
-                '''
-            geolocation_batch = []
-            for zip_code, latitude, longitude in geolocation_data:
-                location_key = location_map.get(zip_code)
-                geolocation_batch.append((latitude, longitude, location_key))
-                if len(geolocation_batch) == 25000:
-                    cur.executemany(insert_geo_loc_data_sql, geolocation_batch)
-                    conn.commit()
-                    geolocation_batch = []
-
-            if geolocation_batch:
-                cur.executemany(insert_geo_loc_data_sql, geolocation_batch)
-                conn.commit()
-            print(f"Inserted data into GeoLocations.")
+                    unique_zip[zip_code] = (row['geolocation_city'], row['geolocation_state'])
+
+        # Inserting unique locations into Locations
+        location_data = ((zip_code, city, state) for zip_code, (city, state) in unique_zip.items())
+        insert_rows(cur, 'Locations', ('zip_code', 'city', 'state'), location_data)
+        print(f"Inserted data into Locations.")
+
+        # Retrieving location keys for GeoLocations
+        location_map = {}
+        cur.execute('SELECT zip_code, location_key FROM Locations')
+        for zip_code, location_key in cur.fetchall():
+            location_map[zip_code] = location_key
+
+        # Streaming the file a second time into GeoLocations using location_key
+        def geolocation_data():
+            with open(geo_file, 'r', encoding='utf-8') as csvfile:
+                reader = csv.DictReader(csvfile)
+                for row in reader:
+                    latitude = float(row['geolocation_lat'])
+                    longitude = float(row['geolocation_lng'])
+                    location_key = location_map.get(row['geolocation_zip_code_prefix'])
+                    yield (latitude, longitude, location_key)
+
+        insert_large_table(cur, 'GeoLocations', ('latitude', 'longitude', 'location_key'), pipelined(geolocation_data()))
+        print(f"Inserted data into GeoLocations.")
 
     except pymysql.Error as e:
         print(f"Error processing geolocation data: {e}")
+        raise
     finally:
         cur.close()
         conn.close()
@@ -228,45 +570,38 @@ def insert_products(product_file, order_items_file):
 
                 product_price_mapping[product_id]['price'] += price
                 product_price_mapping[product_id]['freight_value'] += freight_value
-        with open(product_file, 'r', encoding='utf-8') as csvfile:
-            reader = csv.DictReader(csvfile)
-            product_data = []
-            for row in reader:
-                product_id = row['product_id']
-                product_category = row['product category'] if row['product category'] else None
-                product_name_length = row['product_name_length'] if row['product_name_length'] else None
-                product_description_length = row['product_description_length'] if row['product_description_length'] else None
-                product_photos_qty = row['product_photos_qty'] if row['product_photos_qty'] else None
-                product_weight_g = row['product_weight_g'] if row['product_weight_g'] else None
-                product_length_cm = row['product_length_cm'] if row['product_length_cm'] else None
-                product_height_cm = row['product_height_cm'] if row['product_height_cm'] else None
-                product_width_cm = row['product_width_cm'] if row['product_width_cm'] else None
-
-                price = product_price_mapping[product_id]['price']
-                freight_value = product_price_mapping[product_id]['freight_value']
-                
-
-                product_data.append((product_id, product_category, product_name_length, product_description_length, product_photos_qty, product_weight_g,
-                                     product_length_cm, product_height_cm, product_width_cm, price, freight_value))
-
-                if len(product_data) == 5000:
-                    insert_product_sql = '''
-                        INSERT INTO Products (product_id, product_category, product_name_length, product_description_length, product_photos_qty, product_weight_g,
-                                     product_length_cm, product_height_cm, product_width_cm, price, freight_value)
-                        VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
-                    '''
-                    cur.executemany(insert_product_sql, product_data)
-                    conn.commit()
-                    product_data = []
-
-            if product_data:
-                cur.executemany(insert_product_sql, product_data)
-                conn.commit()
 
+        def product_data():
+            with open(product_file, 'r', encoding='utf-8') as csvfile:
+                reader = csv.DictReader(csvfile)
+                for row in reader:
+                    product_id = row['product_id']
+                    product_category = row['product category'] if row['product category'] else None
+                    product_name_length = row['product_name_length'] if row['product_name_length'] else None
+                    product_description_length = row['product_description_length'] if row['product_description_length'] else None
+                    product_photos_qty = row['product_photos_qty'] if row['product_photos_qty'] else None
+                    product_weight_g = row['product_weight_g'] if row['product_weight_g'] else None
+                    product_length_cm = row['product_length_cm'] if row['product_length_cm'] else None
+                    product_height_cm = row['product_height_cm'] if row['product_height_cm'] else None
+                    product_width_cm = row['product_width_cm'] if row['product_width_cm'] else None
+
+                    price = product_price_mapping[product_id]['price']
+                    freight_value = product_price_mapping[product_id]['freight_value']
+
+                    yield (encode_id(product_id), product_category, product_name_length, product_description_length, product_photos_qty, product_weight_g,
+                           product_length_cm, product_height_cm, product_width_cm, price, freight_value)
+
+        insert_rows(cur, 'Products', ('product_id', 'product_category', 'product_name_length', 'product_description_length', 'product_photos_qty',
+                                      'product_weight_g', 'product_length_cm', 'product_height_cm', 'product_width_cm', 'price', 'freight_value'),
+                    pipelined(product_data()))
         print("Inserted Products data into Products table.")
 
     except pymysql.Error as e:
         print(f"Error inserting product data: {e}")
+        raise
+    finally:
+        cur.close()
+        conn.close()
 
 
 # %%
@@ -277,7 +612,7 @@ def extract_mapping(table_name, id, key):
         cur.execute(query)
         column_names = [desc[0] for desc in cur.description]
         rows = [dict(zip(column_names, row)) for row in cur.fetchall()]
-        return {row[id]: row[key] for row in rows}
+        return {decode_id(row[id]): row[key] for row in rows}
     finally:
         cur.close()
         conn.close()
@@ -288,13 +623,12 @@ def insert_and_map_customers(customer_file, zip_and_locationKey_mapping):
     conn, cur = dbconn()
     # zip_and_locationKey_mapping = zip_locationKey_mapping()
     customer_id_to_customer_key = {}
+    customer_id_and_unique_customer_id_mapping = {}
 
-    try:
+    def customer_data():
         with open(customer_file, 'r', encoding='utf-8') as csvfile:
             reader = csv.DictReader(csvfile)
-            customer_data = []
             unique_customers = {}
-            customer_id_and_unique_customer_id_mapping = {}
 
             for row in reader:
                 customer_id = row['customer_id']
@@ -306,29 +640,14 @@ def insert_and_map_customers(customer_file, zip_and_locationKey_mapping):
 
                 if customer_unique_id not in unique_customers:
                     unique_customers[customer_unique_id] = location_key
-                    customer_data.append((customer_unique_id, location_key))
-
-                if len(customer_data) == 25000:
-                    insert_customer_sql = '''
-                        INSERT INTO Customers (customer_unique_id, location_key)
-                        VALUES (%s, %s)
-                    '''
-                    cur.executemany(insert_customer_sql, customer_data)
-                    conn.commit()
-                    customer_data = []
-
-            if customer_data:
-                insert_customer_sql = '''
-                    INSERT INTO Customers (customer_unique_id, location_key)
-                    VALUES (%s, %s)
-                '''
-                cur.executemany(insert_customer_sql, customer_data)
-                conn.commit()
+                    yield (encode_id(customer_unique_id), location_key)
 
+    try:
+        insert_rows(cur, 'Customers', ('customer_unique_id', 'location_key'), pipelined(customer_data()))
         print("Inserted customer data into Customers table.")
 
         cur.execute('SELECT customer_unique_id, customer_key FROM Customers')
-        unique_customer_key_mapping = dict(cur.fetchall())
+        unique_customer_key_mapping = {decode_id(unique_id): key for unique_id, key in cur.fetchall()}
 
         for customer_id, customer_unique_id in customer_id_and_unique_customer_id_mapping.items():
             customer_key = unique_customer_key_mapping.get(customer_unique_id)
@@ -342,7 +661,7 @@ def insert_and_map_customers(customer_file, zip_and_locationKey_mapping):
 
     except pymysql.Error as e:
         print(f"Error processing customer data: {e}")
-        return {}  # Return empty mapping on error
+        raise
 
     finally:
         cur.close()
@@ -350,22 +669,23 @@ def insert_and_map_customers(customer_file, zip_and_locationKey_mapping):
 
 def insert_orders(orders_file, customer_id_to_customer_key):
     conn, cur = dbconn()
-    try:
+
+    def order_data():
+        def validate_date(date_str):
+            if not date_str or date_str.strip() == '':
+                return None
+            try:
+                parsed_date = datetime.strptime(date_str, '%Y-%m-%d %H:%M:%S')
+                return parsed_date
+            except ValueError:
+                return None
+
         with open(orders_file, 'r', encoding='utf-8') as csvfile:
             reader = csv.DictReader(csvfile)
-            order_data = []
             for row in reader:
                 order_id = row['order_id']
                 customer_id = row['customer_id']
                 order_status = row['order_status']
-                def validate_date(date_str):
-                    if not date_str or date_str.strip() == '':
-                        return None
-                    try:
-                        parsed_date = datetime.strptime(date_str, '%Y-%m-%d %H:%M:%S')
-                        return parsed_date
-                    except ValueError:
-                        return None
 
                 order_purchase_date = validate_date(row['order_purchase_timestamp'])
                 order_approved_date = validate_date(row['order_approved_at'])
@@ -375,27 +695,18 @@ def insert_orders(orders_file, customer_id_to_customer_key):
                 customer_key = customer_id_to_customer_key.get(customer_id)
 
                 if customer_key:
-                    order_data.append((customer_key, order_id, order_status, order_purchase_date, order_approved_date, order_delivered_carrier_date,
-                                       order_delivered_customer_date, order_estimated_delivery_date))
-
-                if len(order_data) == 25000:
-                    insert_order_sql = '''
-                        INSERT INTO Orders (customer_key, order_id, order_status, order_purchase_date, order_approved_date, order_delivered_carrier_date,
-                                       order_delivered_customer_date, order_estimated_delivery_date)
-                        VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
-                    '''
-                    cur.executemany(insert_order_sql, order_data)
-                    conn.commit()
-                    order_data = []
-
-            if order_data:
-                cur.executemany(insert_order_sql, order_data)
-                conn.commit()
+                    yield (customer_key, encode_id(order_id), order_status, order_purchase_date, order_approved_date, order_delivered_carrier_date,
+                           order_delivered_customer_date, order_estimated_delivery_date)
 
+    try:
+        insert_rows(cur, 'Orders', ('customer_key', 'order_id', 'order_status', 'order_purchase_date', 'order_approved_date',
+                                    'order_delivered_carrier_date', 'order_delivered_customer_date', 'order_estimated_delivery_date'),
+                    pipelined(order_data()))
         print("Inserted orders into Orders table.")
 
     except pymysql.Error as e:
         print(f"Error inserting orders: {e}")
+        raise
     finally:
         cur.close()
         conn.close()
@@ -421,7 +732,7 @@ def insert_sellers(seller_file, zip_and_locationKey_mapping):
                 location_key = zip_and_locationKey_mapping.get(seller_zip_code_prefix, None)
 
                 if location_key:
-                    seller_data.append((seller_id, location_key))
+                    seller_data.append((encode_id(seller_id), location_key))
 
                 else:
                     if seller_zip_code_prefix not in unique_missing_zip:
@@ -430,28 +741,11 @@ def insert_sellers(seller_file, zip_and_locationKey_mapping):
                             missing_location_records.append((seller_zip_code_prefix, seller_state, seller_state))
                     pending_seller_records.append((seller_id, seller_zip_code_prefix))
 
-                if len(seller_data) == 1000:
-                    insert_seller_sql = '''
-                        INSERT INTO Sellers (seller_id, location_key)
-                        VALUES (%s, %s)
-                    '''
-                    cur.executemany(insert_seller_sql, seller_data)
-                    conn.commit()
-                    seller_data = []
-
-            if seller_data:
-                cur.executemany(insert_seller_sql, seller_data)
-                conn.commit()
+            insert_rows(cur, 'Sellers', ('seller_id', 'location_key'), seller_data)
 
         # Handling missing locations
         if missing_location_records:
-
-            insert_missing_location_sql = '''
-                INSERT INTO Locations (zip_code, city, state)
-                VALUES (%s, %s, %s)
-            '''
-            cur.executemany(insert_missing_location_sql, missing_location_records)
-            conn.commit()
+            insert_rows(cur, 'Locations', ('zip_code', 'city', 'state'), missing_location_records)
 
             # Fetching new location keys for the inserted zip codes
             cur.execute('SELECT zip_code, location_key FROM Locations WHERE zip_code IN %s', (tuple(unique_missing_zip),))
@@ -462,25 +756,28 @@ def insert_sellers(seller_file, zip_and_locationKey_mapping):
 
             # Inserting sellers with newly fetched location keys
             new_seller_data = [
-                (seller_id, zip_and_locationKey_mapping[seller_zip_code_prefix])
+                (encode_id(seller_id), zip_and_locationKey_mapping[seller_zip_code_prefix])
                 for seller_id, seller_zip_code_prefix in pending_seller_records
             ]
-            cur.executemany(insert_seller_sql, new_seller_data)
-            conn.commit()
+            insert_rows(cur, 'Sellers', ('seller_id', 'location_key'), new_seller_data)
 
         print("Inserted Seller data into Sellers table.")
 
     except pymysql.Error as e:
         print(f"Error inserting seller data: {e}")
+        raise
+    finally:
+        cur.close()
+        conn.close()
 
 
 # %%
 def insert_payments(payments_file, order_id_to_order_key):
     conn, cur = dbconn()
-    try:
+
+    def payments_data():
         with open(payments_file, 'r', encoding='utf-8') as csvfile:
             reader = csv.DictReader(csvfile)
-            payments_data = []
             processed_data = {}
 
             for row in reader:
@@ -503,27 +800,25 @@ def insert_payments(payments_file, order_id_to_order_key):
                     processed_data[key]['installments'] += installments
                     processed_data[key]['payment_value'] += payment_value
 
-            for (order_id, payment_sequential), values in processed_data.items():
-                order_key = order_id_to_order_key.get(order_id)
-                if order_key:
-                    payments_data.append((
-                        order_key,
-                        values['payment_type'],
-                        values['installments'],
-                        values['payment_value']
-                    ))
-
-            insert_payments_query = """
-                INSERT INTO Payments (order_key, payment_type, payment_installments, payment_value)
-                VALUES (%s, %s, %s, %s)
-            """
-            cur.executemany(insert_payments_query, payments_data)
-            conn.commit()
-            print(f"Successfully inserted payments data into Payments.")
+        for (order_id, payment_sequential), values in processed_data.items():
+            order_key = order_id_to_order_key.get(order_id)
+            if order_key:
+                yield (
+                    order_key,
+                    values['payment_type'],
+                    values['installments'],
+                    values['payment_value']
+                )
+
+    try:
+        insert_rows(cur, 'Payments', ('order_key', 'payment_type', 'payment_installments', 'payment_value'),
+                    pipelined(payments_data()))
+        print(f"Successfully inserted payments data into Payments.")
 
     except Exception as e:
         conn.rollback()
         print(f"An error occurred: {e}")
+        raise
     finally:
         cur.close()
         conn.close()
@@ -531,12 +826,13 @@ def insert_payments(payments_file, order_id_to_order_key):
 
 # %%
 from collections import defaultdict
-def insert_order_items(order_items_file, order_id_to_order_key, product_id_to_product_key, seller_id_to_seller_key):
+def insert_order_items(order_items_file, order_id_to_order_key, product_id_to_product_key, seller_id_to_seller_key,
+                       order_key_to_purchase_date=None):
     conn, cur = dbconn()
-    try:
+
+    def order_items_data():
         with open(order_items_file, 'r', encoding='utf-8') as csvfile:
             reader = csv.DictReader(csvfile)
-            order_items_data = []
             processed_data = defaultdict(lambda: {'qty': 0, 'unit_price': 0, 'total_price': 0})
             
             for row in reader:               
@@ -556,48 +852,66 @@ def insert_order_items(order_items_file, order_id_to_order_key, product_id_to_pr
                 processed_data[key]['total_price'] = processed_data[key]['qty'] * unit_price
                 processed_data[key]['seller_id'] = seller_id
 
-            order_items_data = []
-            # product_info = {}
-            for (order_id, product_id), values in processed_data.items():
-                seller_key = seller_id_to_seller_key.get(values['seller_id'], None)
-                product_key = product_id_to_product_key.get(product_id, None)
-                order_key = order_id_to_order_key.get(order_id, None)
-                if order_key and product_key and seller_key:
-                    order_items_data.append((
-                        order_key, product_key, seller_key,
-                        values['unit_price'], values['qty'], values['total_price']
-                    ))
-                # if product_key:
-                #     product_info.append((values['price'], values['freight_value'], product_id))
-
-            insert_order_items_query = """
-                INSERT INTO OrderItems (order_key, product_key, seller_key, unit_price, qty, total_price)
-                VALUES (%s, %s, %s, %s, %s, %s)
-            """
-            cur.executemany(insert_order_items_query, order_items_data)
-            conn.commit()
-
-            # update_product_details_in_Products_query = """
-            #     UPDATE Products
-            #     SET
-            #     price = %s,
-            #     freight_value = %s
-            #     WHERE product_key = %s
-            # """
-            # cur.executemany(update_product_details_in_Products_query, product_info)
-            # conn.commit()
+        for (order_id, product_id), values in processed_data.items():
+            seller_key = seller_id_to_seller_key.get(values['seller_id'], None)
+            product_key = product_id_to_product_key.get(product_id, None)
+            order_key = order_id_to_order_key.get(order_id, None)
+            if order_key and product_key and seller_key:
+                order_item = (
+                    order_key, product_key, seller_key,
+                    values['unit_price'], values['qty'], values['total_price']
+                )
+                # The partitioned OrderItems table carries its order's purchase date as the partitioning column
+                if order_key_to_purchase_date is not None:
+                    order_item += (order_key_to_purchase_date[order_key],)
+                yield order_item
+
+    columns = ('order_key', 'product_key', 'seller_key', 'unit_price', 'qty', 'total_price')
+    if order_key_to_purchase_date is not None:
+        columns += ('order_purchase_date',)
+    try:
+        insert_large_table(cur, 'OrderItems', columns, pipelined(order_items_data()))
 
     except Exception as e:
         conn.rollback()
         print(f"Error: {e}")
+        raise
     finally:
         conn.close()
 
-
-
 # %%
 # Main function
 def main():
+    global compact_ids, partitioned, parallel_shards
+    parser = argparse.ArgumentParser(description="Create the tables and load the Target e-commerce csv files.")
+    parser.add_argument("--compact-ids", action="store_true",
+                        help="store order, customer, product and seller ids as BINARY(16) instead of VARCHAR(100)")
+    parser.add_argument("--partitioned", action="store_true",
+                        help="range-partition Orders and OrderItems by purchase month")
+    parser.add_argument("--add-partition", metavar="YYYY-MM", type=month_argument, action="append", default=[],
+                        help="split a new month out of pmax in the partitioned tables, then exit")
+    parser.add_argument("--drop-partition", metavar="YYYY-MM", type=month_argument, action="append", default=[],
+                        help="delete a month's orders, order items and payments from the partitioned tables, then exit")
+    parser.add_argument("--parallel", type=int, default=1, metavar="N",
+                        help="insert GeoLocations and OrderItems over N connections at once")
+    parser.add_argument("--profile", choices=profile_modes,
+                        help="profile each load stage and write the output to profiles/")
+    parser.add_argument("--profile-stage", metavar="NAME", action="append", default=[],
+                        help="only profile this stage, e.g. insert_orders (can be repeated)")
+    args = parser.parse_args()
+    compact_ids = args.compact_ids
+    partitioned = args.partitioned
+    parallel_shards = max(1, args.parallel)
+
+    # Partition maintenance runs against the existing tables instead of reloading them
+    if args.add_partition or args.drop_partition:
+        succeeded = all([add_partition(month) for month in args.add_partition] +
+                        [drop_partition(month) for month in args.drop_partition])
+        if not succeeded:
+            sys.exit(1)
+        write_data_version()
+        return
+
     geo_file = 'geolocation.csv'
     products_file = 'products.csv'
     customers_file = 'customers.csv'
@@ -606,19 +920,33 @@ def main():
     order_items_file = 'order_items.csv'
     payments_file = 'payments.csv'
 
-    create_tables()
-    insert_locations_and_geolocation(geo_file)
-    insert_products(products_file, order_items_file)
-    zipcode_to_location_key = extract_mapping("Locations", "zip_code", "location_key")
-    customer_id_to_customer_key = insert_and_map_customers(customers_file, zipcode_to_location_key)
-    insert_orders(orders_file, customer_id_to_customer_key)
-    insert_sellers(sellers_file, zipcode_to_location_key)
-    order_id_to_order_key = extract_mapping("Orders", "order_id", "order_key")
-    insert_payments(payments_file, order_id_to_order_key)
-    product_id_to_product_key = extract_mapping("Products", "product_id", "product_key")
-    seller_id_to_seller_key = extract_mapping("Sellers", "seller_id", "seller_key")
-    insert_order_items(order_items_file, order_id_to_order_key, product_id_to_product_key, seller_id_to_seller_key)
-    
+    # Runs one load stage, under the profiler when it was asked for
+    def run_stage(stage, *stage_args):
+        mode = args.profile if not args.profile_stage or stage.__name__ in args.profile_stage else None
+        with profile_section(stage.__name__, mode):
+            return stage(*stage_args)
+
+    # Each stage raises on failure; the data version only changes once every stage has loaded
+    try:
+        run_stage(create_tables)
+        run_stage(insert_locations_and_geolocation, geo_file)
+        run_stage(insert_products, products_file, order_items_file)
+        zipcode_to_location_key = run_stage(extract_mapping, "Locations", "zip_code", "location_key")
+        customer_id_to_customer_key = run_stage(insert_and_map_customers, customers_file, zipcode_to_location_key)
+        run_stage(insert_orders, orders_file, customer_id_to_customer_key)
+        run_stage(insert_sellers, sellers_file, zipcode_to_location_key)
+        order_id_to_order_key = run_stage(extract_mapping, "Orders", "order_id", "order_key")
+        run_stage(insert_payments, payments_file, order_id_to_order_key)
+        product_id_to_product_key = run_stage(extract_mapping, "Products", "product_id", "product_key")
+        seller_id_to_seller_key = run_stage(extract_mapping, "Sellers", "seller_id", "seller_key")
+        order_key_to_purchase_date = run_stage(extract_mapping, "Orders", "order_key", "order_purchase_date") if partitioned else None
+        run_stage(insert_order_items, order_items_file, order_id_to_order_key, product_id_to_product_key, seller_id_to_seller_key,
+                  order_key_to_purchase_date)
+    except Exception as e:
+        print(f"Load failed, data version not updated: {e}")
+        sys.exit(1)
+    write_data_version()
+
 
 # %%
 if __name__ == "__main__":
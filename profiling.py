@@ -0,0 +1,164 @@
+import cProfile
+import itertools
+import pstats
+import sys
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+from pathlib import Path
+
+# Profiles are only collected when asked for (?profile= / X-Profile on the API, --profile on the loader)
+# and written to this directory:
+#   sample   -> <name>.folded, collapsed stacks for flamegraph.pl, speedscope or inferno
+#   cprofile -> <name>.prof, pstats output for snakeviz, flameprof or gprof2dot
+profile_dir = Path("profiles")
+profile_modes = ("sample", "cprofile")
+file_counter = itertools.count(1)
+
+def profile_path(name, suffix):
+    profile_dir.mkdir(exist_ok=True)
+    return profile_dir / f"{name}-{time.strftime('%Y%m%d-%H%M%S')}-{next(file_counter)}{suffix}"
+
+# Samples the Python stacks of one thread (or of every thread when thread_id is None) on a background thread
+class SamplingProfiler:
+    def __init__(self, thread_id=None, interval=0.001):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.samples = Counter()
+        self.stopped = threading.Event()
+        self.sampler = threading.Thread(target=self.sample, daemon=True)
+
+    def start(self):
+        self.sampler.start()
+
+    def stop(self):
+        self.stopped.set()
+        self.sampler.join()
+
+    def sample(self):
+        own_id = threading.get_ident()
+        while not self.stopped.wait(self.interval):
+            thread_names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id or (self.thread_id is not None and thread_id != self.thread_id):
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{code.co_name} ({Path(code.co_filename).name}:{code.co_firstlineno})")
+                    frame = frame.f_back
+                if self.thread_id is None:
+                    stack.append(thread_names.get(thread_id, str(thread_id)))
+                self.samples[";".join(reversed(stack))] += 1
+
+    def write(self, name):
+        path = profile_path(name, ".folded")
+        path.write_text("".join(f"{stack} {count}\n" for stack, count in self.samples.items()))
+        return path
+
+# cProfile of the starting thread, merged with the profiles of threads run through profiled() and of worker processes
+class CProfileProfiler:
+    def __init__(self):
+        self.profile = cProfile.Profile()
+        self.thread_profiles = []
+        self.lock = threading.Lock()
+
+    def start(self):
+        self.profile.enable()
+
+    def stop(self):
+        self.profile.disable()
+
+    def write(self, name):
+        path = profile_path(name, ".prof")
+        stats = pstats.Stats(self.profile)
+        with self.lock:
+            for thread_profile in self.thread_profiles:
+                stats.add(thread_profile)
+        stats.dump_stats(path)
+        return path
+
+# Returns None when the profiler cannot start: from Python 3.12 only one cProfile can be active at a time
+def start_profile(mode, thread_id=None):
+    profiler = CProfileProfiler() if mode == "cprofile" else SamplingProfiler(thread_id)
+    try:
+        profiler.start()
+    except ValueError:
+        return None
+    return profiler
+
+# Profiler of the loader stage currently running, if any
+active_profiler = None
+
+@contextmanager
+def profile_section(name, mode):
+    global active_profiler
+    if mode not in profile_modes:
+        yield
+        return
+    active_profiler = start_profile(mode)
+    if active_profiler is None:
+        print(f"Could not start the {mode} profiler for {name}, another profiler is active")
+        yield
+        return
+    try:
+        yield
+    finally:
+        profiler, active_profiler = active_profiler, None
+        profiler.stop()
+        print(f"Profile of {name} written to {profiler.write(name)}")
+
+# Wraps a thread target so a cProfile section also covers the work done on that thread.
+# From Python 3.12 cProfile already sees every thread (and allows only one active profiler), so no wrapping is needed.
+def profiled(target):
+    profiler = active_profiler
+    if not isinstance(profiler, CProfileProfiler) or sys.version_info >= (3, 12):
+        return target
+
+    def run(*args, **kwargs):
+        thread_profile = cProfile.Profile()
+        try:
+            thread_profile.enable()
+        except ValueError:
+            return target(*args, **kwargs)
+        try:
+            return target(*args, **kwargs)
+        finally:
+            thread_profile.disable()
+            with profiler.lock:
+                profiler.thread_profiles.append(thread_profile)
+    return run
+
+# Work done in a separate process is not seen by the profilers of this one. With a cProfile section active,
+# workers run their task under their own cProfile (run_profiled) and the raw stats are sent back and merged
+# into the section (add_worker_stats). The sampling profiler only covers this process.
+def worker_profile_mode():
+    return "cprofile" if isinstance(active_profiler, CProfileProfiler) else None
+
+def run_profiled(function, *args):
+    worker_profile = cProfile.Profile()
+    try:
+        worker_profile.enable()
+    except ValueError:
+        return function(*args), None
+    try:
+        result = function(*args)
+    finally:
+        worker_profile.disable()
+    worker_profile.create_stats()
+    return result, worker_profile.stats
+
+# pstats.Stats.add() accepts any object with create_stats() and a stats dict
+class WorkerStats:
+    def __init__(self, stats):
+        self.stats = stats
+
+    def create_stats(self):
+        pass
+
+def add_worker_stats(stats):
+    profiler = active_profiler
+    if stats and isinstance(profiler, CProfileProfiler):
+        with profiler.lock:
+            profiler.thread_profiles.append(WorkerStats(stats))